@@ -13,70 +13,470 @@ __email__ = "info@mhcomm.fr"
 Simple MTA that sends mails via msgraph
 """
 # #############################################################################
+from __future__ import annotations
+
 import argparse
-import email
-import json
+import gzip
 import logging
 import os
+import re
 import sys
+import time
 
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from functools import partial
+from itertools import chain
 from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import BinaryIO
+from typing import Iterable
+from typing import Iterator
+from urllib.parse import quote
 
-import requests
+import orjson
 
-from msal import ConfidentialClientApplication
+if TYPE_CHECKING:
+    from email.message import EmailMessage
+    from email.message import MIMEPart
+    from mmap import mmap
 
 logger = logging.getLogger(__name__)
 # CONFIG_FILE = Path.home() / ".msgraph-sendmail.json"
 GRAPH_ENDPOINT = "https://graph.microsoft.com/v1.0"
+TOKEN_CACHE_FILE = Path.home() / ".cache" / "msgmta" / "token.json"
 SCOPES = ["https://graph.microsoft.com/.default"]
+TOKEN_MIN_LIFETIME = 300  # seconds a cached token must still be valid
 VERBOSE = False
+BATCH_SIZE = 20  # max. number of requests graph accepts per $batch call
+MBOX_FROM = b"From "
+MBOX_QUOTED_FROM = re.compile(rb">+From ")  # loses one '>' when read
+CHUNK_SIZE = 64 * 1024
+GZIP_MIN_SIZE = 4096  # request bodies larger than this are compressed
+_GZIP_BODIES = True  # False once graph refused a compressed body
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+
+def mk_client_kwargs(max_connections=4):
+    """
+    arguments for an httpx client, that keeps HTTP/2 connections alive
+    """
+    import httpx
+
+    return dict(
+        http2=True,
+        timeout=30.0,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    )
+
+
+# shared by msal and graph requests, so that connections are reused
+_CLIENT = None
+
+
+def get_client():
+    """
+    return the shared httpx client (created on first use, as
+    importing httpx is expensive compared to parsing the arguments)
+    """
+    import httpx
+
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.Client(**mk_client_kwargs())
+    return _CLIENT
+
+
+def _retry_delay(headers, attempt):
+    retry_after = headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return int(retry_after)
+    return BACKOFF_FACTOR * 2 ** attempt
+
+
+def compress_body(body, headers):
+    """
+    gzip compress a request body if it is large and graph did not
+    refuse compressed bodies yet.
+    returns the body and the headers to send it with.
+    """
+    if not _GZIP_BODIES or body is None or len(body) <= GZIP_MIN_SIZE:
+        return body, headers
+    return (
+        gzip.compress(body, compresslevel=1),
+        {**headers, "Content-Encoding": "gzip"},
+    )
+
+
+def _gzip_refused(response, body, sent_body):
+    """
+    did graph refuse a compressed body (not every endpoint accepts one)?
+    Compression is switched off for the following requests if so.
+    """
+    global _GZIP_BODIES
+    if response.status_code != 415 or sent_body is body:
+        return False
+    logger.info("graph refused a gzip compressed body, sending it plain")
+    _GZIP_BODIES = False
+    return True
 
 
-def vprint(*args, **kwargs):
+def post(url, headers=None, content=None, **kwargs):
+    """
+    post with the shared client.
+    Large bodies are sent gzip compressed, or plain if graph refuses that.
+    Requests graph asked to retry (throttling, server errors) are retried.
+    """
+    client = get_client()
+    headers = headers or {}
+    sent_body, sent_headers = compress_body(content, headers)
+    response = client.post(
+        url, headers=sent_headers, content=sent_body, **kwargs)
+    if _gzip_refused(response, content, sent_body):
+        sent_body, sent_headers = content, headers
+        response = client.post(
+            url, headers=sent_headers, content=sent_body, **kwargs)
+    for attempt in range(RETRIES):
+        if response.status_code not in RETRY_STATUSES:
+            break
+        time.sleep(_retry_delay(response.headers, attempt))
+        response = client.post(
+            url, headers=sent_headers, content=sent_body, **kwargs)
+    return response
+
+
+async def apost(client, url, headers=None, content=None, **kwargs):
+    """
+    post with an httpx.AsyncClient, compressing and retrying like post()
     """
-    print if verbose
+    import asyncio
+
+    headers = headers or {}
+    sent_body, sent_headers = compress_body(content, headers)
+    response = await client.post(
+        url, headers=sent_headers, content=sent_body, **kwargs)
+    if _gzip_refused(response, content, sent_body):
+        sent_body, sent_headers = content, headers
+        response = await client.post(
+            url, headers=sent_headers, content=sent_body, **kwargs)
+    for attempt in range(RETRIES):
+        if response.status_code not in RETRY_STATUSES:
+            break
+        await asyncio.sleep(_retry_delay(response.headers, attempt))
+        response = await client.post(
+            url, headers=sent_headers, content=sent_body, **kwargs)
+    return response
+
+
+def vprint(fmt, *args, **kwargs):
+    """
+    print fmt.format(*args) if verbose.
+    formatting is skipped otherwise, so pass large values as args
     """
     if not VERBOSE:
         return
-    print(*args, **kwargs)
+    print(fmt.format(*args), **kwargs)
 
 
 def load_config(configfile):
     cfg_path = Path(configfile)
-    with cfg_path.open() as fin:
-        data = json.load(fin)
-        entry = data["default"]
-        return {
-            "tenant_id": entry["tenant_id"],
-            "client_id": entry["application_id"],
-            "client_secret": entry["secret_value"],
-            "from_address": entry["sender"],
-        }
-
-
-def get_access_token(config):
-    app = ConfidentialClientApplication(
+    data = orjson.loads(cfg_path.read_bytes())
+    entry = data["default"]
+    return {
+        "tenant_id": entry["tenant_id"],
+        "client_id": entry["application_id"],
+        "client_secret": entry["secret_value"],
+        "from_address": entry["sender"],
+    }
+
+
+def load_token_cache(cache_path):
+    """
+    load msal's token cache from disk.
+    The cache is empty if the file does not exist or cannot be read.
+    """
+    from msal import SerializableTokenCache
+
+    cache = SerializableTokenCache()
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return cache
+    try:
+        cache.deserialize(cache_path.read_text())
+    except (OSError, ValueError) as exc:
+        logger.warning("could not load token cache %s: %s", cache_path, exc)
+        return SerializableTokenCache()
+    return cache
+
+
+def save_token_cache(cache, cache_path):
+    """
+    save msal's token cache to disk if it changed.
+    The file is readable by the owner only and replaced atomically.
+    """
+    if not cache.has_state_changed:
+        return
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fout:
+        fout.write(cache.serialize())
+    os.replace(tmp_path, cache_path)
+
+
+@lru_cache(maxsize=8)
+def _get_token_cache(cache_path):
+    return load_token_cache(cache_path)
+
+
+@lru_cache(maxsize=8)
+def _get_app(tenant_id, client_id, client_secret, cache_path):
+    """
+    msal application per tenant and client.
+    creating one costs a tenant discovery request.
+    """
+    from msal import ConfidentialClientApplication
+
+    return ConfidentialClientApplication(
+        client_id,
+        authority=f"https://login.microsoftonline.com/{tenant_id}",
+        client_credential=client_secret,
+        token_cache=_get_token_cache(cache_path),
+        http_client=get_client(),
+    )
+
+
+def find_cached_token(cache, tenant_id, client_id):
+    """
+    return a cached access token for graph, that is still valid for
+    TOKEN_MIN_LIFETIME seconds, or None.
+    """
+    entries = cache.search(
+        cache.CredentialType.ACCESS_TOKEN,
+        target=SCOPES,
+        query={"client_id": client_id, "realm": tenant_id},
+    )
+    min_expires_on = time.time() + TOKEN_MIN_LIFETIME
+    for entry in entries:
+        if int(entry["expires_on"]) > min_expires_on:
+            return entry["secret"]
+    return None
+
+
+def get_access_token(config, cache_path=TOKEN_CACHE_FILE):
+    """
+    get an access token for graph.
+    A cached token is returned without creating an msal application,
+    so that only the first of many invocations has to contact AAD.
+    """
+    cache_path = str(cache_path)
+    cache = _get_token_cache(cache_path)
+    token = find_cached_token(cache, config["tenant_id"], config["client_id"])
+    if token:
+        return token
+
+    app = _get_app(
+        config["tenant_id"],
         config["client_id"],
-        authority=f"https://login.microsoftonline.com/{config['tenant_id']}",
-        client_credential=config["client_secret"]
+        config["client_secret"],
+        cache_path,
     )
 
     result = app.acquire_token_for_client(scopes=SCOPES)
+    try:
+        save_token_cache(cache, cache_path)
+    except OSError as exc:
+        logger.warning("could not save token cache %s: %s", cache_path, exc)
     if "access_token" not in result:
         raise Exception(f"Could not obtain token: {result}")
     return result["access_token"]
 
 
-def fmt_recipients(recipients):
+def fmt_recipients(recipients: Iterable[str]) -> list[dict]:
+    """
+    format recipients for graph.
+    recipients: header values or arguments, each with one or more addresses
+    """
+    from email.utils import getaddresses
+
     return [
-        {"emailAddress": {"address": addr.strip()}}
-        for addr in recipients
+        {"emailAddress": {"address": addr}}
+        for _, addr in getaddresses(recipients)
+        if addr
     ]
 
 
-def parse_email_message(raw_data):
-    msg = email.message_from_string(raw_data)
+def open_debug_file(debug_path):
+    """
+    create a new file (readable by the owner only) for saving a raw mail
+    in debug_path and return its file descriptor.
+    """
+    debug_path = Path(debug_path)
+    debug_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    now = datetime.now().strftime("%Y%m%d-%H%M%S")
+    for ctr in range(1000):
+        name = f"{now}.raw" if ctr == 0 else f"{now}_{ctr}.raw"
+        try:
+            fd = os.open(
+                debug_path / name,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                0o600,
+            )
+        except FileExistsError:
+            continue
+        vprint("saving raw mail to {}", debug_path / name)
+        return fd
+    raise FileExistsError(f"no free name for {now}.raw in {debug_path}")
+
+
+def _write_all(fd: int, data: bytes | bytearray) -> None:
+    with memoryview(data) as view:
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:])
+
+
+@contextmanager
+def open_input(fin):
+    """
+    return a binary stream to read a mail from fin.
+    If fin is a regular file, it is memory mapped, so that reading it
+    costs neither read syscalls nor copies through fin's buffer.
+    """
+    import mmap
+    import stat
+
+    try:
+        fd = fin.fileno()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, ValueError):  # e.g. BytesIO
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode) or st.st_size <= fin.tell():
+        yield fin
+        return
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+        mapped.seek(fin.tell())
+        yield mapped
+
+
+def iter_messages(
+    fin: BinaryIO | mmap,
+    chunk_size: int = CHUNK_SIZE,
+    tee_fd: int | None = None,
+) -> Iterator[EmailMessage]:
+    """
+    parse mails from a binary stream while reading it.
+    If the stream is an mbox (starts with a 'From ' line) every message
+    is yielded, else the whole stream is one message.
+
+    tee_fd: optional file descriptor, that gets a copy of everything read.
+    The copy is written with os.write, chunk by chunk, while parsing.
+    """
+    import email.policy
+
+    from email.message import EmailMessage
+    from email.parser import BytesFeedParser
+
+    def new_parser():
+        return BytesFeedParser(EmailMessage, policy=email.policy.default)
+
+    parser = new_parser()
+    first_line = fin.readline()
+    if not first_line.startswith(MBOX_FROM):
+        chunks = iter(partial(fin.read, chunk_size), b"")
+        for chunk in chain([first_line], chunks):
+            if tee_fd is not None:
+                _write_all(tee_fd, chunk)
+            parser.feed(chunk)
+        yield parser.close()
+        return
+
+    # mbox lines are collected, so that the copy costs one write per chunk.
+    # it is flushed before each yield, so it is complete up to the message,
+    # that is processed (the caller may stop there).
+    tee_buf = bytearray()
+
+    def tee(data, flush=False):
+        if tee_fd is None:
+            return
+        tee_buf.extend(data)
+        if flush or len(tee_buf) >= chunk_size:
+            _write_all(tee_fd, tee_buf)
+            tee_buf.clear()
+
+    tee(first_line)
+    # a blank line is only fed once it is clear, that it does not
+    # separate the message from the next 'From ' line
+    blank = None
+    for line in iter(fin.readline, b""):
+        if blank is not None and line.startswith(MBOX_FROM):
+            tee(line, flush=True)
+            yield parser.close()
+            parser = new_parser()
+            blank = None
+            continue
+        tee(line)
+        if blank is not None:
+            parser.feed(blank)
+            blank = None
+        if not line.strip():
+            blank = line
+            continue
+        if MBOX_QUOTED_FROM.match(line):
+            line = line[1:]
+        parser.feed(line)
+    tee(b"", flush=True)
+    yield parser.close()
+
+
+def _find_text_plain(msg: MIMEPart) -> MIMEPart | None:
+    """
+    return the first text/plain part of a multipart message or None.
+    Skipped parts are not decoded.
+    """
+    for part in msg.iter_parts():
+        if part.is_multipart():
+            found = _find_text_plain(part)
+            if found is not None:
+                return found
+        elif part.get_content_type() == "text/plain":
+            return part
+    return None
+
+
+def _get_text(part: MIMEPart) -> str:
+    """
+    decoded content of a part as text.
+    Text without charset parameter and non-text parts are decoded as utf-8.
+    """
+    if part.get_content_maintype() == "text" and part.get_param("charset"):
+        return part.get_content()
+    payload = part.get_payload(decode=True)
+    if not isinstance(payload, bytes):
+        return ""
+    return payload.decode(part.get_content_charset("utf-8"), errors="replace")
+
+
+def parse_email_message(
+    msg: EmailMessage | bytes,
+) -> tuple[str, list[dict], str, str]:
+    """
+    msg: a parsed EmailMessage or the raw bytes of a mail
+    """
+    import email
+    import email.policy
+
+    if isinstance(msg, bytes):
+        msg = email.message_from_bytes(msg, policy=email.policy.default)
 
     to_addrs = msg.get_all("To", [])
     cc_addrs = msg.get_all("Cc", [])
@@ -86,36 +486,27 @@ def parse_email_message(raw_data):
     # Microsoft Graph does not support BCC directly
     # — skip it or handle differently
 
-    recipients = fmt_recipients(to_addrs + cc_addrs)
+    recipients = fmt_recipients(chain(to_addrs, cc_addrs))
 
-    subject = msg.get("Subject", "")
+    subject = str(msg.get("Subject", ""))
     content_type = "text/plain"
     content = ""
 
     if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                content = (
-                    part.get_payload(decode=True)
-                    .decode(part.get_content_charset("utf-8"))
-                )
-                break
+        part = _find_text_plain(msg)
+        if part is not None:
+            content = _get_text(part)
     else:
-        content = (
-            msg.get_payload(decode=True)
-            .decode(msg.get_content_charset("utf-8"))
-        )
+        content = _get_text(msg)
 
     return subject, recipients, content_type, content
 
 
-def send_mail(token, sender, subject, recipients, content_type, content):
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    data = {
+def mk_mail_payload(sender, subject, recipients, content_type, content):
+    """
+    create the json payload for graph's sendMail
+    """
+    return {
         "message": {
             "subject": subject,
             "body": {
@@ -130,24 +521,176 @@ def send_mail(token, sender, subject, recipients, content_type, content):
         "saveToSentItems": "true"
     }
 
-    response = requests.post(
-        f"{GRAPH_ENDPOINT}/users/{sender}/sendMail",
+
+@lru_cache(maxsize=32)
+def send_mail_path(sender):
+    """
+    path of sender's sendMail endpoint (relative to GRAPH_ENDPOINT),
+    with the sender percent-encoded (e.g. for '+' in addresses)
+    """
+    return f"/users/{quote(sender, safe='@')}/sendMail"
+
+
+def send_mail(token, sender, subject, recipients, content_type, content):
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+
+    data = mk_mail_payload(sender, subject, recipients, content_type, content)
+
+    response = post(
+        f"{GRAPH_ENDPOINT}{send_mail_path(sender)}",
         headers=headers,
-        json=data
+        content=orjson.dumps(data)
     )
 
-    if not response.ok:
+    if not response.is_success:
         raise Exception(
             f"Graph sendMail failed: {response.status_code} {response.text}")
 
     logger.info("Message sent successfully")
 
 
+def _post_batch(headers, sender, items):
+    """
+    post one $batch request of sendMail requests and return graph's
+    sub responses.
+
+    items: (id, (subject, recipients, content_type, content)) tuples
+    """
+    data = {
+        "requests": [
+            {
+                "id": str(idx),
+                "method": "POST",
+                "url": send_mail_path(sender),
+                "headers": {"Content-Type": "application/json"},
+                "body": mk_mail_payload(sender, *parsed),
+            }
+            for idx, parsed in items
+        ]
+    }
+
+    response = post(
+        f"{GRAPH_ENDPOINT}/$batch",
+        headers=headers,
+        content=orjson.dumps(data)
+    )
+
+    if not response.is_success:
+        raise Exception(
+            f"Graph $batch failed: {response.status_code} {response.text}")
+
+    return response.json()["responses"]
+
+
+def send_mails_batch(token, sender, parsed_list):
+    """
+    send multiple mails with graph's $batch endpoint,
+    BATCH_SIZE mails per request.
+    Sub requests graph asked to retry (graph runs them in parallel, so
+    they are often throttled) are resent in a new $batch request.
+
+    parsed_list: list of (subject, recipients, content_type, content)
+    """
+    import httpx
+
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+
+    errors = []
+    pending = list(range(len(parsed_list)))
+    for attempt in range(RETRIES + 1):
+        retry = []
+        delay = 0
+        for start in range(0, len(pending), BATCH_SIZE):
+            items = [
+                (idx, parsed_list[idx])
+                for idx in pending[start:start + BATCH_SIZE]
+            ]
+            for sub_response in _post_batch(headers, sender, items):
+                status = sub_response["status"]
+                if 200 <= status < 300:
+                    continue
+                if status in RETRY_STATUSES and attempt < RETRIES:
+                    retry.append(int(sub_response["id"]))
+                    sub_headers = httpx.Headers(sub_response.get("headers", {}))
+                    delay = max(delay, _retry_delay(sub_headers, attempt))
+                    continue
+                errors.append(
+                    f"{sub_response['id']}: {status} {sub_response.get('body')}")
+        if not retry:
+            break
+        time.sleep(delay)
+        pending = sorted(retry)
+
+    if errors:
+        raise Exception(f"Graph sendMail failed: {'; '.join(errors)}")
+
+    logger.info("%d messages sent successfully", len(parsed_list))
+
+
+async def _send_one(client, semaphore, url, headers, payload):
+    body = orjson.dumps(payload)
+    async with semaphore:
+        response = await apost(client, url, headers=headers, content=body)
+    if not response.is_success:
+        raise Exception(
+            f"Graph sendMail failed: {response.status_code} {response.text}")
+
+
+async def _send_mails_async(token, sender, parsed_list, concurrency):
+    import asyncio
+
+    import httpx
+
+    url = f"{GRAPH_ENDPOINT}{send_mail_path(sender)}"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    # HTTP/2 multiplexes all requests over one connection, so the number
+    # of requests in flight is limited by a semaphore, not by the pool
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(**mk_client_kwargs(concurrency)) as client:
+        tasks = [
+            _send_one(
+                client, semaphore, url, headers,
+                mk_mail_payload(sender, *parsed))
+            for parsed in parsed_list
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def send_mails_concurrently(token, sender, parsed_list, concurrency=10):
+    """
+    send multiple mails with up to concurrency sendMail requests in
+    parallel, so that the waiting times for graph overlap.
+
+    parsed_list: list of (subject, recipients, content_type, content)
+    """
+    import asyncio
+
+    results = asyncio.run(
+        _send_mails_async(token, sender, parsed_list, concurrency))
+    errors = [str(result) for result in results if isinstance(result, Exception)]
+    if errors:
+        raise Exception("; ".join(errors))
+
+    logger.info("%d messages sent successfully", len(parsed_list))
+
+
 def mk_parser():
     """ commandline parser """
     description = "no description given"
     default_cfg = str(Path.home() / ".config" / "msgmta.json")
     default_cfg = os.environ.get("MSGMTA_CONFIG", default_cfg)
+    default_debug_dir = os.environ.get("MSGMTA_DEBUG_DIR")
+    default_cache = os.environ.get(
+        "MSGMTA_TOKEN_CACHE", str(TOKEN_CACHE_FILE))
 
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument(
@@ -156,6 +699,25 @@ def mk_parser():
         default=default_cfg,
         help="config file to read from: default=%(default)s",
     )
+    parser.add_argument(
+        '--token-cache',
+        default=default_cache,
+        help="file to cache access tokens in: default=%(default)s",
+    )
+    parser.add_argument(
+        '--debug-dir',
+        default=default_debug_dir,
+        help="save the raw mails read from stdin to this directory",
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=1,
+        help=(
+            "number of mails to send in parallel. default=%(default)s "
+            "(multiple mails are sent with $batch requests)"
+        ),
+    )
     parser.add_argument(
         '--verbose',
         '-v',
@@ -172,32 +734,46 @@ def main():
     options = mk_parser().parse_args()
     VERBOSE = options.verbose
 
-    raw_email = sys.stdin.read()
     cfg_path = Path(options.config)
     config = load_config(cfg_path)
-    token = get_access_token(config)
-
-    subject, recipients, content_type, content = parse_email_message(raw_email)
-    vprint(f"parsed: {(subject, recipients, content_type, content)}")
-
-    recipients = recipients or []
-    recipients.extend(fmt_recipients(options.recipients))
-    subject = subject or options.subject
-    vprint(f"{recipients=}")
-    vprint(f"{subject=}")
-
-    if not recipients:
-        logger.error("No recipients found in email headers")
-        sys.exit(1)
-
-    send_mail(
-        token,
-        sender=config["from_address"],
-        subject=subject,
-        recipients=recipients,
-        content_type=content_type,
-        content=content
-    )
+    token = get_access_token(config, cache_path=options.token_cache)
+
+    debug_fd = None
+    if options.debug_dir:
+        debug_fd = open_debug_file(options.debug_dir)
+
+    mails = []
+    try:
+        with open_input(sys.stdin.buffer) as fin:
+            for msg in iter_messages(fin, tee_fd=debug_fd):
+                subject, recipients, content_type, content = (
+                    parse_email_message(msg))
+                vprint(
+                    "parsed: {!r}",
+                    (subject, recipients, content_type, content))
+
+                recipients = recipients or []
+                recipients.extend(fmt_recipients(options.recipients))
+                subject = subject or options.subject
+                vprint("recipients={!r}", recipients)
+                vprint("subject={!r}", subject)
+
+                if not recipients:
+                    logger.error("No recipients found in email headers")
+                    sys.exit(1)
+                mails.append((subject, recipients, content_type, content))
+    finally:
+        if debug_fd is not None:
+            os.close(debug_fd)
+
+    sender = config["from_address"]
+    if len(mails) > 1 and options.concurrency > 1:
+        send_mails_concurrently(
+            token, sender, mails, concurrency=options.concurrency)
+    elif len(mails) > 1:
+        send_mails_batch(token, sender, mails)
+    else:
+        send_mail(token, sender, *mails[0])
 
 
 if __name__ == '__main__':
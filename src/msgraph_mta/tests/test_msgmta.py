@@ -1,8 +1,14 @@
+import asyncio
+import gzip
+import io
+import os
 import sys
 
 from pathlib import Path
 from unittest.mock import patch
 
+import httpx
+import orjson
 import pytest
 
 import msgraph_mta.msgmta
@@ -31,3 +37,490 @@ def test_show_help(capsys):
         with capsys.disabled():
             print(captured)
         assert "usage: msgmta" in captured
+
+
+def test_load_config(tmp_path):
+    """
+    the default entry is read from the config file
+    """
+    cfg_path = tmp_path / "msgmta.json"
+    cfg_path.write_bytes(orjson.dumps({"default": {
+        "tenant_id": "tenant",
+        "application_id": "cid",
+        "secret_value": "secret",
+        "sender": "sender@example.com",
+    }}))
+    assert msgraph_mta.msgmta.load_config(cfg_path) == {
+        "tenant_id": "tenant",
+        "client_id": "cid",
+        "client_secret": "secret",
+        "from_address": "sender@example.com",
+    }
+
+
+def test_token_cache_roundtrip(tmp_path):
+    """
+    token cache is written owner readable only and can be read back
+    """
+    cache_path = tmp_path / "sub" / "token.json"
+    cache = msgraph_mta.msgmta.load_token_cache(cache_path)
+    cache.add({
+        "client_id": "cid",
+        "scope": ["scope"],
+        "token_endpoint": "https://login.example.com/tenant/token",
+        "response": {"access_token": "tok", "expires_in": 3600},
+    })
+    msgraph_mta.msgmta.save_token_cache(cache, cache_path)
+    assert cache_path.stat().st_mode & 0o777 == 0o600
+
+    cache = msgraph_mta.msgmta.load_token_cache(cache_path)
+    tokens = cache.search(cache.CredentialType.ACCESS_TOKEN)
+    assert [token["secret"] for token in tokens] == ["tok"]
+
+
+def test_token_cache_unreadable(tmp_path):
+    """
+    a corrupt or unreadable token cache is ignored
+    """
+    cache_path = tmp_path / "token.json"
+    cache_path.write_text("{no json")
+    cache = msgraph_mta.msgmta.load_token_cache(cache_path)
+    assert list(cache.search(cache.CredentialType.ACCESS_TOKEN)) == []
+
+    with patch.object(Path, "read_text", side_effect=PermissionError):
+        cache = msgraph_mta.msgmta.load_token_cache(cache_path)
+    assert list(cache.search(cache.CredentialType.ACCESS_TOKEN)) == []
+
+
+def test_get_access_token_cached(tmp_path):
+    """
+    a valid cached token is returned without contacting AAD
+    """
+    cache_path = tmp_path / "token.json"
+    cache = msgraph_mta.msgmta.load_token_cache(cache_path)
+    cache.add({
+        "client_id": "cid",
+        "scope": msgraph_mta.msgmta.SCOPES,
+        "token_endpoint": (
+            "https://login.microsoftonline.com/tenant/oauth2/v2.0/token"),
+        "response": {"access_token": "tok", "expires_in": 3600},
+    })
+    msgraph_mta.msgmta.save_token_cache(cache, cache_path)
+
+    config = {"tenant_id": "tenant", "client_id": "cid", "client_secret": "s"}
+    with patch.object(msgraph_mta.msgmta, "get_client") as get_client:
+        get_client.side_effect = AssertionError("no request expected")
+        token = msgraph_mta.msgmta.get_access_token(config, cache_path)
+    assert token == "tok"
+
+
+MBOX = b"""From alice@example.com Mon Jan  1 00:00:00 2024
+To: bob@example.com
+Subject: first
+
+body one
+>From escaped
+>>From twice
+
+From alice@example.com Mon Jan  1 00:00:01 2024
+To: carol@example.com
+Subject: second
+
+body two
+"""
+
+
+MULTIPART = b"""To: bob@example.com
+Cc: carol@example.com
+Subject: =?utf-8?q?gr=C3=BC=C3=9Fe?=
+MIME-Version: 1.0
+Content-Type: multipart/alternative; boundary="XXX"
+
+--XXX
+Content-Type: text/html; charset="utf-8"
+
+<p>html</p>
+--XXX
+Content-Type: text/plain; charset="iso-8859-1"
+Content-Transfer-Encoding: quoted-printable
+
+gr=FC=DFe
+--XXX--
+"""
+
+
+def test_iter_messages():
+    """
+    mbox data is split into messages, other data is one message
+    """
+    messages = list(msgraph_mta.msgmta.iter_messages(io.BytesIO(MBOX)))
+    assert [msg["To"] for msg in messages] == [
+        "bob@example.com", "carol@example.com"]
+    assert messages[0].get_content() == (
+        "body one\nFrom escaped\n>From twice\n")
+    assert messages[1].get_content() == "body two\n"
+
+    single = b"To: bob@example.com\n\nFrom here on\n"
+    messages = list(
+        msgraph_mta.msgmta.iter_messages(io.BytesIO(single), chunk_size=4))
+    assert len(messages) == 1
+    assert messages[0].get_content() == "From here on\n"
+
+
+def test_open_input(tmp_path):
+    """
+    regular files are memory mapped from their current position,
+    other streams are returned unchanged
+    """
+    mbox_path = tmp_path / "mbox"
+    mbox_path.write_bytes(b"skipped" + MBOX)
+    with mbox_path.open("rb") as fin:
+        fin.seek(len(b"skipped"))
+        with msgraph_mta.msgmta.open_input(fin) as mapped:
+            assert mapped is not fin
+            messages = list(msgraph_mta.msgmta.iter_messages(mapped))
+    assert [msg["Subject"] for msg in messages] == ["first", "second"]
+
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, "rb") as fin, os.fdopen(write_fd, "wb"):
+        with msgraph_mta.msgmta.open_input(fin) as stream:
+            assert stream is fin
+
+
+def test_debug_file(tmp_path):
+    """
+    raw mails are saved to new files, that are readable by the owner only
+    """
+    debug_path = tmp_path / "debug"
+    fd = msgraph_mta.msgmta.open_debug_file(debug_path)
+    messages = list(msgraph_mta.msgmta.iter_messages(
+        io.BytesIO(MBOX), chunk_size=16, tee_fd=fd))
+    os.close(fd)
+    assert len(messages) == 2
+    fd = msgraph_mta.msgmta.open_debug_file(debug_path)
+    messages = list(msgraph_mta.msgmta.iter_messages(
+        io.BytesIO(MULTIPART), chunk_size=16, tee_fd=fd))
+    os.close(fd)
+    assert len(messages) == 1
+
+    paths = sorted(debug_path.iterdir())
+    assert len(paths) == 2
+    assert {path.read_bytes() for path in paths} == {MBOX, MULTIPART}
+    assert all(path.stat().st_mode & 0o777 == 0o600 for path in paths)
+
+
+def test_debug_file_mbox_writes():
+    """
+    mbox lines are written in chunks, not line by line
+    """
+    body = b"".join(b"line %d\n" % idx for idx in range(2000))
+    mbox = MBOX.replace(b"body one\n", body).replace(b"body two\n", body)
+    writes = []
+    os_write = os.write
+
+    def write(fd, data):
+        writes.append(len(data))
+        return os_write(fd, data)
+
+    read_fd, write_fd = os.pipe()
+    with patch.object(msgraph_mta.msgmta.os, "write", write):
+        with os.fdopen(read_fd, "rb") as fin:
+            messages = msgraph_mta.msgmta.iter_messages(
+                io.BytesIO(mbox), chunk_size=4096, tee_fd=write_fd)
+            assert len(list(messages)) == 2
+            os.close(write_fd)
+            assert fin.read() == mbox
+    # one write per chunk_size bytes plus one per message boundary
+    assert len(writes) <= len(mbox) // 4096 + 3
+
+
+def test_send_mail_path():
+    """
+    the sender is percent-encoded in the url path
+    """
+    assert msgraph_mta.msgmta.send_mail_path("a+b@example.com") == (
+        "/users/a%2Bb@example.com/sendMail")
+
+
+def test_send_mails_batch():
+    """
+    mails are grouped into $batch requests and failed sub requests raise
+    """
+    mails = [
+        (f"subject {idx}", [], "text/plain", "content")
+        for idx in range(msgraph_mta.msgmta.BATCH_SIZE + 1)
+    ]
+    with patch.object(msgraph_mta.msgmta, "_CLIENT") as client:
+        response = client.post.return_value
+        response.status_code = 200
+        response.is_success = True
+        response.json.side_effect = [
+            {"responses": [{"id": "0", "status": 202}]},
+            {"responses": [{"id": "20", "status": 400, "body": "bad"}]},
+        ]
+        with pytest.raises(Exception, match="20: 400 bad"):
+            msgraph_mta.msgmta.send_mails_batch(
+                "token", "sender@example.com", mails)
+
+    assert client.post.call_count == 2
+    first_call, second_call = client.post.call_args_list
+    assert first_call.kwargs["headers"]["Content-Encoding"] == "gzip"
+    first = orjson.loads(gzip.decompress(first_call.kwargs["content"]))
+    second = orjson.loads(second_call.kwargs["content"])
+    assert len(first["requests"]) == msgraph_mta.msgmta.BATCH_SIZE
+    assert second["requests"][0]["id"] == "20"
+
+
+def test_send_mails_batch_throttled():
+    """
+    throttled sub requests are resent after their Retry-After delay
+    """
+    mails = [
+        (f"subject {idx}", [], "text/plain", "content") for idx in range(3)]
+    with patch.object(msgraph_mta.msgmta, "_CLIENT") as client, \
+            patch.object(msgraph_mta.msgmta.time, "sleep") as sleep:
+        response = client.post.return_value
+        response.status_code = 200
+        response.is_success = True
+        response.json.side_effect = [
+            {"responses": [
+                {"id": "0", "status": 202},
+                {"id": "1", "status": 429, "headers": {"Retry-After": "7"}},
+                {"id": "2", "status": 202},
+            ]},
+            {"responses": [{"id": "1", "status": 202}]},
+        ]
+        msgraph_mta.msgmta.send_mails_batch(
+            "token", "sender@example.com", mails)
+
+    sleep.assert_called_once_with(7)
+    assert client.post.call_count == 2
+    retried = orjson.loads(client.post.call_args.kwargs["content"])
+    assert [request["id"] for request in retried["requests"]] == ["1"]
+    assert retried["requests"][0]["body"]["message"]["subject"] == "subject 1"
+
+    throttled = {"responses": [{"id": "0", "status": 429, "body": "busy"}]}
+    with patch.object(msgraph_mta.msgmta, "_CLIENT") as client, \
+            patch.object(msgraph_mta.msgmta.time, "sleep"):
+        response = client.post.return_value
+        response.status_code = 200
+        response.is_success = True
+        response.json.return_value = throttled
+        with pytest.raises(Exception, match="0: 429 busy"):
+            msgraph_mta.msgmta.send_mails_batch(
+                "token", "sender@example.com", mails[:1])
+    assert client.post.call_count == msgraph_mta.msgmta.RETRIES + 1
+
+
+def test_send_mails_concurrently():
+    """
+    every mail is posted, failed sends are raised with graph's answer
+    """
+    subjects = []
+
+    def handler(request):
+        subject = orjson.loads(request.content)["message"]["subject"]
+        subjects.append(subject)
+        if subject == "bad":
+            return httpx.Response(400, text="invalid recipient")
+        return httpx.Response(202)
+
+    async_client = httpx.AsyncClient
+
+    def mk_async_client(**kwargs):
+        return async_client(transport=httpx.MockTransport(handler))
+
+    mails = [
+        (subject, [], "text/plain", "content")
+        for subject in ("one", "bad", "three", "four")
+    ]
+    with patch.object(httpx, "AsyncClient", mk_async_client):
+        with pytest.raises(Exception, match="400 invalid recipient"):
+            msgraph_mta.msgmta.send_mails_concurrently(
+                "token", "sender@example.com", mails, concurrency=2)
+    assert sorted(subjects) == sorted(mail[0] for mail in mails)
+
+
+@pytest.mark.parametrize("concurrency, expected", [
+    ("1", "send_mails_batch"),
+    ("2", "send_mails_concurrently"),
+])
+def test_main_concurrency(concurrency, expected):
+    """
+    multiple mails are only sent in parallel with --concurrency > 1
+    """
+    newargs = mk_args("--concurrency", concurrency)
+    stdin = io.TextIOWrapper(io.BytesIO(MBOX))
+    config = {"from_address": "sender@example.com"}
+    with patch.object(sys, "argv", newargs), \
+            patch.object(sys, "stdin", stdin), \
+            patch.object(msgraph_mta.msgmta, "load_config", return_value=config), \
+            patch.object(msgraph_mta.msgmta, "get_access_token"), \
+            patch.object(msgraph_mta.msgmta, "send_mails_batch") as batch, \
+            patch.object(
+                msgraph_mta.msgmta, "send_mails_concurrently") as parallel:
+        msgraph_mta.msgmta.main()
+    called = {"send_mails_batch": batch, "send_mails_concurrently": parallel}
+    for name, mock in called.items():
+        assert mock.called == (name == expected)
+    mails = called[expected].call_args.args[2]
+    assert [mail[0] for mail in mails] == ["first", "second"]
+
+
+def mk_mock_transport(*statuses):
+    """
+    transport answering with statuses in turn, Retry-After: 0 for 429
+    """
+    responses = iter(statuses)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        status = next(responses)
+        headers = {"Retry-After": "0"} if status == 429 else {}
+        return httpx.Response(status, headers=headers, text=str(status))
+
+    return httpx.MockTransport(handler), requests
+
+
+@pytest.mark.parametrize("statuses, expected, count", [
+    ((429, 202), 202, 2),
+    ((400, 202), 400, 1),
+    ((503,) * (msgraph_mta.msgmta.RETRIES + 1), 503,
+     msgraph_mta.msgmta.RETRIES + 1),
+])
+def test_post_retries(statuses, expected, count):
+    """
+    only retryable statuses are retried, the last response is returned
+    """
+    transport, requests = mk_mock_transport(*statuses)
+    client = httpx.Client(transport=transport)
+    with patch.object(msgraph_mta.msgmta, "_CLIENT", client), \
+            patch.object(msgraph_mta.msgmta.time, "sleep") as sleep:
+        response = msgraph_mta.msgmta.post("https://graph.example.com/x")
+    assert response.status_code == expected
+    assert len(requests) == count
+    assert sleep.call_count == count - 1
+    if statuses[0] == 429:
+        sleep.assert_called_with(0)
+
+
+@pytest.mark.parametrize("statuses, expected, count", [
+    ((429, 202), 202, 2),
+    ((400, 202), 400, 1),
+])
+def test_apost_retries(statuses, expected, count):
+    """
+    apost() retries like post()
+    """
+    transport, requests = mk_mock_transport(*statuses)
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await msgraph_mta.msgmta.apost(
+                client, "https://graph.example.com/x")
+
+    response = asyncio.run(run())
+    assert response.status_code == expected
+    assert len(requests) == count
+
+
+def test_compress_body():
+    """
+    only large bodies are compressed
+    """
+    headers = {"Content-Type": "application/json"}
+    body, small_headers = msgraph_mta.msgmta.compress_body(b"{}", headers)
+    assert body == b"{}"
+    assert small_headers == headers
+
+    data = b"x" * (msgraph_mta.msgmta.GZIP_MIN_SIZE + 1)
+    body, large_headers = msgraph_mta.msgmta.compress_body(data, headers)
+    assert gzip.decompress(body) == data
+    assert large_headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in headers
+
+
+def test_post_gzip_refused():
+    """
+    a body graph refused compressed is resent plain, later ones are
+    not compressed anymore
+    """
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.headers.get("Content-Encoding") == "gzip":
+            return httpx.Response(415, text="unsupported media type")
+        return httpx.Response(202)
+
+    transport = httpx.MockTransport(handler)
+    client = httpx.Client(transport=transport)
+    data = b"x" * (msgraph_mta.msgmta.GZIP_MIN_SIZE + 1)
+    headers = {"Content-Type": "application/json"}
+    with patch.object(msgraph_mta.msgmta, "_CLIENT", client), \
+            patch.object(msgraph_mta.msgmta, "_GZIP_BODIES", True):
+        response = msgraph_mta.msgmta.post(
+            "https://graph.example.com/x", headers=headers, content=data)
+        assert response.status_code == 202
+        assert [req.headers.get("Content-Encoding") for req in requests] == [
+            "gzip", None]
+        assert requests[1].content == data
+
+        msgraph_mta.msgmta.post(
+            "https://graph.example.com/x", headers=headers, content=data)
+        assert len(requests) == 3
+        assert "Content-Encoding" not in requests[2].headers
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as aclient:
+            return await msgraph_mta.msgmta.apost(
+                aclient, "https://graph.example.com/x",
+                headers=headers, content=data)
+
+    requests.clear()
+    with patch.object(msgraph_mta.msgmta, "_GZIP_BODIES", True):
+        assert asyncio.run(run()).status_code == 202
+    assert [req.headers.get("Content-Encoding") for req in requests] == [
+        "gzip", None]
+
+
+def test_parse_email_message():
+    """
+    subject and text/plain part are decoded
+    """
+    subject, recipients, content_type, content = (
+        msgraph_mta.msgmta.parse_email_message(MULTIPART))
+    assert subject == "grüße"
+    assert recipients == [
+        {"emailAddress": {"address": "bob@example.com"}},
+        {"emailAddress": {"address": "carol@example.com"}},
+    ]
+    assert content_type == "text/plain"
+    assert content == "grüße"
+
+    # no charset parameter: utf-8 as before, not ascii
+    _, _, _, content = msgraph_mta.msgmta.parse_email_message(
+        "To: bob@example.com\n\nHällo\n".encode())
+    assert content == "Hällo\n"
+
+    # single part, that is not text
+    _, _, _, content = msgraph_mta.msgmta.parse_email_message(
+        b"To: bob@example.com\n"
+        b"Content-Type: application/octet-stream\n"
+        b"Content-Transfer-Encoding: base64\n"
+        b"\n"
+        b"aGVsbG8=\n")
+    assert content == "hello"
+
+
+def test_fmt_recipients():
+    """
+    headers with multiple addresses and display names are split
+    """
+    recipients = msgraph_mta.msgmta.fmt_recipients([
+        "Bob <bob@example.com>, carol@example.com",
+        " dave@example.com ",
+    ])
+    assert [entry["emailAddress"]["address"] for entry in recipients] == [
+        "bob@example.com", "carol@example.com", "dave@example.com"]